@@ -8,36 +8,73 @@ This will install QuickUMLS and its dependencies in a clean environment
 import subprocess
 import sys
 import os
+import shutil
+import argparse
 import tempfile
+import textwrap
+from concurrent.futures import ThreadPoolExecutor
 
-def run_command(cmd, description=""):
-    """Run a command and handle errors"""
+# Keep pip output short (no progress bars or version-check notices) and prefer wheels
+pip_env = {
+    "PIP_PROGRESS_BAR": "off",
+    "PIP_DISABLE_PIP_VERSION_CHECK": "1",
+    "PIP_PREFER_BINARY": "1",
+    **os.environ
+}
+
+# Packages that take minutes to compile from source; only install them as wheels
+binary_only_packages = ["numpy", "scipy", "scikit-learn"]
+
+def run_command(cmd, description="", verbose=True):
+    """Run a command (given as an argument list) and handle errors"""
     print(f"\n{'='*60}")
     print(f"Running: {description}")
-    print(f"Command: {' '.join(cmd) if isinstance(cmd, list) else cmd}")
+    print(f"Command: {' '.join(cmd)}")
     print(f"{'='*60}")
     
+    # The child writes straight to our file descriptors, so flush the banner first
+    sys.stdout.flush()
+    sys.stderr.flush()
+    
+    # Output goes straight to our terminal instead of being buffered; when quiet,
+    # stdout is discarded and stderr is kept only to report failures
     try:
-        result = subprocess.run(cmd, shell=isinstance(cmd, str), capture_output=True, text=True, check=True)
-        if result.stdout:
-            print("STDOUT:")
-            print(result.stdout)
-        if result.stderr:
-            print("STDERR:")
-            print(result.stderr)
+        if verbose:
+            result = subprocess.run(cmd, env=pip_env, check=True)
+        else:
+            result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                    text=True, env=pip_env, check=True)
         print(f"✓ {description} completed successfully")
         return result
     except subprocess.CalledProcessError as e:
         print(f"✗ {description} failed with exit code {e.returncode}")
-        if e.stdout:
-            print("STDOUT:")
-            print(e.stdout)
         if e.stderr:
             print("STDERR:")
             print(e.stderr)
         return None
 
+def missing_packages(venv_python, packages):
+    """Return the packages that are not installed in the virtual environment"""
+    check_script = (
+        "import sys, importlib.metadata as md\n"
+        "for name in sys.argv[1:]:\n"
+        "    try:\n"
+        "        md.distribution(name)\n"
+        "    except md.PackageNotFoundError:\n"
+        "        print(name)\n"
+    )
+    result = subprocess.run([venv_python, "-c", check_script] + packages,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        return list(packages)
+    return result.stdout.split()
+
 def main():
+    parser = argparse.ArgumentParser(description='Install QuickUMLS in a virtual environment')
+    parser.add_argument('--clean', action='store_true',
+                       help='Remove and recreate the virtual environment')
+    args = parser.parse_args()
+    
     print("=== QuickUMLS Clean Installation ===")
     print(f"Python version: {sys.version}")
     print(f"Python executable: {sys.executable}")
@@ -46,27 +83,16 @@ def main():
     # Create a virtual environment for clean installation
     venv_path = "/oscar/home/isarkar/sarkarcode/thera-ie/quickumls_venv"
     
-    print(f"\n1. Creating virtual environment at: {venv_path}")
-    if os.path.exists(venv_path):
-        print("Removing existing virtual environment...")
-        run_command(f"rm -rf {venv_path}", "Remove existing venv")
-    
-    result = run_command([sys.executable, "-m", "venv", venv_path], "Create virtual environment")
-    if not result:
-        print("Failed to create virtual environment")
-        return False
-    
     # Paths for the virtual environment
     venv_python = f"{venv_path}/bin/python"
     venv_pip = f"{venv_path}/bin/pip"
     
-    print(f"\n2. Upgrading pip in virtual environment")
-    result = run_command([venv_pip, "install", "--upgrade", "pip"], "Upgrade pip")
-    if not result:
-        print("Failed to upgrade pip")
-        return False
+    # Prefer cached wheels over rebuilding from source on repeated runs
+    pip_options = ["--prefer-binary", "--no-build-isolation",
+                   f"--only-binary={','.join(binary_only_packages)}"]
+    pip_install = [venv_pip, "install"] + pip_options
     
-    print(f"\n3. Installing required dependencies")
+    # Required dependencies
     dependencies = [
         "wheel",
         "setuptools",
@@ -76,59 +102,127 @@ def main():
         "nltk",
         "spacy",
         "unidecode",
+        "orjson",  # Fast JSON output for quickumls_wrapper.py
         "leveldb"  # Important for QuickUMLS
     ]
     
-    for dep in dependencies:
-        result = run_command([venv_pip, "install", dep], f"Install {dep}")
+    print(f"\n1. Creating virtual environment at: {venv_path}")
+    if os.path.exists(venv_path) and args.clean:
+        print("Removing existing virtual environment...")
+        try:
+            shutil.rmtree(venv_path)
+        except OSError as e:
+            print(f"✗ Failed to remove existing virtual environment: {e}")
+            return False
+    
+    reuse_venv = os.path.exists(venv_python)
+    if reuse_venv:
+        check = subprocess.run([venv_python, "-c", "import quickumls"], capture_output=True)
+        # Dependencies added since the last install still need to be installed
+        missing = missing_packages(venv_python, dependencies)
+        if check.returncode == 0 and not missing:
+            print("\n" + "="*60)
+            print("✓ QuickUMLS is already installed, nothing to do")
+            print(f"Virtual environment: {venv_path}")
+            print("Use --clean to reinstall from scratch")
+            print("="*60)
+            return True
+        print("Reusing existing virtual environment...")
+    else:
+        result = run_command([sys.executable, "-m", "venv", venv_path], "Create virtual environment")
+        if not result:
+            print("Failed to create virtual environment")
+            return False
+    
+    print(f"\n2. Upgrading pip in virtual environment")
+    # Build tools are needed up front since builds run without isolation
+    result = run_command([venv_pip, "install", "--upgrade", "pip", "setuptools", "wheel"],
+                         "Upgrade pip")
+    if not result:
+        print("Failed to upgrade pip")
+        return False
+    
+    print(f"\n3. Installing required dependencies")
+    if reuse_venv:
+        # Only touch what is missing, unless installed packages are inconsistent
+        check = subprocess.run([venv_pip, "check"], capture_output=True)
+        if check.returncode == 0:
+            dependencies = missing
+        pip_install = pip_install + ["--upgrade"]
+    
+    # Fail early if a wheel is missing for this platform rather than compiling from source
+    binary_dependencies = [dep for dep in dependencies if dep in binary_only_packages]
+    if binary_dependencies:
+        result = run_command([venv_pip, "install", "--dry-run", "--only-binary=:all:"]
+                             + binary_dependencies, "Check for pre-built wheels")
         if not result:
-            print(f"Warning: Failed to install {dep}, continuing...")
+            print(f"No pre-built wheels for {', '.join(binary_dependencies)} on this Python/platform")
+            return False
+    
+    # Install everything in one pip invocation so pip resolves and downloads once
+    if not dependencies:
+        print("All dependencies already installed")
+    elif not run_command(pip_install + dependencies, "Install dependencies"):
+        # Fall back to handling each dependency on its own so one bad package
+        # does not block the rest
+        print("Batch install failed, retrying dependencies individually...")
+        with tempfile.TemporaryDirectory() as download_dir:
+            # Downloads only wait on the network, so threads suffice; parallel pip
+            # output would interleave, so only status and errors are reported
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                downloads = list(executor.map(
+                    lambda dep: run_command([venv_pip, "download", "-d", download_dir]
+                                            + pip_options + [dep],
+                                            f"Download {dep}", verbose=False),
+                    dependencies))
+            
+            # Install one at a time: concurrent pips would unpack shared
+            # dependencies such as numpy into site-packages at the same time
+            for dep, downloaded in zip(dependencies, downloads):
+                if not downloaded or not run_command(
+                        pip_install + ["--no-index", "--find-links", download_dir, dep],
+                        f"Install {dep}"):
+                    print(f"Warning: Failed to install {dep}, continuing...")
     
     print(f"\n4. Installing QuickUMLS")
-    result = run_command([venv_pip, "install", "quickumls"], "Install QuickUMLS")
+    result = run_command(pip_install + ["quickumls"], "Install QuickUMLS")
     if not result:
         print("Failed to install QuickUMLS")
         return False
     
     print(f"\n5. Testing QuickUMLS import")
-    test_script = f"""
-import sys
-sys.path.insert(0, '{venv_path}/lib/python3.11/site-packages')
-
-try:
-    from quickumls import QuickUMLS
-    print("✓ QuickUMLS imported successfully")
-    
-    # Try basic functionality test
-    print("✓ QuickUMLS installation appears successful")
-    
-except ImportError as e:
-    print(f"✗ QuickUMLS import failed: {{e}}")
-    sys.exit(1)
-except Exception as e:
-    print(f"✗ QuickUMLS test failed: {{e}}")
-    sys.exit(1)
-"""
+    # The venv interpreter already has its own site-packages on sys.path
+    test_script = textwrap.dedent("""
+        import sys
+        
+        try:
+            from quickumls import QuickUMLS
+            print("✓ QuickUMLS imported successfully")
+            
+            # Try basic functionality test
+            print("✓ QuickUMLS installation appears successful")
+            
+        except ImportError as e:
+            print(f"✗ QuickUMLS import failed: {e}")
+            sys.exit(1)
+        except Exception as e:
+            print(f"✗ QuickUMLS test failed: {e}")
+            sys.exit(1)
+        """)
     
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
-        f.write(test_script)
-        test_file = f.name
-    
-    try:
-        result = run_command([venv_python, test_file], "Test QuickUMLS import")
-        if result:
-            print("\n" + "="*60)
-            print("✓ QuickUMLS installation completed successfully!")
-            print(f"Virtual environment: {venv_path}")
-            print(f"Python executable: {venv_python}")
-            print(f"To use: source {venv_path}/bin/activate")
-            print("="*60)
-            return True
-        else:
-            print("✗ QuickUMLS installation test failed")
-            return False
-    finally:
-        os.unlink(test_file)
+    # Run the test inline rather than through a temporary script file
+    result = run_command([venv_python, "-c", test_script], "Test QuickUMLS import")
+    if result:
+        print("\n" + "="*60)
+        print("✓ QuickUMLS installation completed successfully!")
+        print(f"Virtual environment: {venv_path}")
+        print(f"Python executable: {venv_python}")
+        print(f"To use: source {venv_path}/bin/activate")
+        print("="*60)
+        return True
+    else:
+        print("✗ QuickUMLS installation test failed")
+        return False
 
 if __name__ == "__main__":
     success = main()
@@ -10,6 +10,14 @@ import os
 import sys
 import json
 import argparse
+import collections
+import functools
+import heapq
+import importlib.metadata
+import itertools
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 # Set up environment for libiconv
 libiconv_path = "/oscar/rt/9.2/software/0.20-generic/0.20.1/opt/spack/linux-rhel9-x86_64_v3/gcc-11.3.1/libiconv-1.17-jwjcds2nmpz7gpstqq22vty7jxldvpec/lib/libiconv.so.2"
@@ -18,106 +26,544 @@ libiconv_path = "/oscar/rt/9.2/software/0.20-generic/0.20.1/opt/spack/linux-rhel
 import ctypes
 ctypes.CDLL(libiconv_path, mode=ctypes.RTLD_GLOBAL)
 
+# Import once at startup; report a missing package when the matcher is built
+try:
+    from quickumls import QuickUMLS
+except ImportError as e:
+    QuickUMLS = None
+    _quickumls_import_error = e
+
+# orjson serializes large batch outputs much faster; fall back to the json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def dumps(obj, indent=False):
+    """Serialize an object to a JSON string (sets are written as lists)"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=list,
+                            option=orjson.OPT_INDENT_2 if indent else 0).decode()
+    return json.dumps(obj, default=list, indent=2 if indent else None)
+
+# Use the existing QuickUMLS index
+index_path = '/users/isarkar/sarkarcode/_data/quickumls/quickumls_index'
+
+# Matcher settings; part of the query cache identity
+match_threshold = 0.7
+match_window = 5
+
+# Results persisted across runs, keyed by normalized term (see normalize_term)
+query_cache_path = os.path.join(os.path.dirname(index_path), 'query_cache.db')
+use_query_cache = True
+
+# Terms shorter than this cannot map to a concept and are skipped
+min_token_len = 3
+
+# Matcher built by initialize_quickumls(), shared by the query cache
+_matcher = None
+
+# In-memory LRU of recent results, keyed by normalized term
+_memory_cache = collections.OrderedDict()
+_memory_cache_size = 50000
+_memory_lock = threading.Lock()
+
+# Terms sent to each worker process at a time; each chunk is one cache commit
+worker_chunk_size = 64
+
+# Per-process SQLite connection for the query cache (False if unavailable)
+_cache_db = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
 def initialize_quickumls():
-    """Initialize QuickUMLS matcher"""
+    """Initialize QuickUMLS matcher (built once per process)"""
+    global _matcher
+    if _matcher is not None:
+        return _matcher
+    
     try:
-        from quickumls import QuickUMLS
-        
-        # Use the existing QuickUMLS index
-        index_path = '/users/isarkar/sarkarcode/_data/quickumls/quickumls_index'
+        if QuickUMLS is None:
+            raise _quickumls_import_error
         
         if not os.path.exists(index_path):
-            print(json.dumps({"error": f"QuickUMLS index not found at {index_path}"}))
+            print(dumps({"error": f"QuickUMLS index not found at {index_path}"}))
             sys.exit(1)
         
-        matcher = QuickUMLS(index_path, threshold=0.7, window=5)
-        return matcher
+        _matcher = QuickUMLS(index_path, threshold=match_threshold, window=match_window)
+        return _matcher
         
     except Exception as e:
-        print(json.dumps({"error": f"QuickUMLS initialization failed: {str(e)}"}))
+        print(dumps({"error": f"QuickUMLS initialization failed: {str(e)}"}))
         sys.exit(1)
 
+def parse_terms(matcher, terms):
+    """Tokenize terms in one spaCy pass, keyed by term ({} if unsupported)"""
+    # Relies on QuickUMLS internals, so fall back to per-term parsing if they differ
+    if not (hasattr(matcher, 'nlp') and hasattr(matcher, '_match')):
+        return {}
+    try:
+        return dict(zip(terms, matcher.nlp.pipe(terms, batch_size=256, n_process=1)))
+    except Exception:
+        return {}
+
+def collect_concepts(matcher, term, doc=None):
+    """Run the matcher on a term and return all matched concepts"""
+    if doc is not None:
+        matches = matcher._match(doc, best_match=True, ignore_syntax=False)
+    else:
+        matches = matcher.match(term, best_match=True, ignore_syntax=False)
+    
+    results = []
+    for concept in itertools.chain.from_iterable(matches):
+        # Handle preferred name (could be string or index into the match)
+        preferred = concept.get('preferred', '')
+        if isinstance(preferred, str):
+            preferred_name = preferred
+        else:
+            preferred_name = concept.get('term', str(preferred))
+        
+        results.append({
+            "cui": concept.get('cui', ''),
+            "preferred_name": preferred_name,
+            "similarity": concept.get('similarity', 0.0),
+            # Left as a set; dumps() serializes it as a list
+            "semtypes": concept.get('semtypes', ()),
+            "method": "quickumls"
+        })
+    
+    return results
+
+def match_concepts(matcher, term, doc=None):
+    """Run the matcher on a term and return its top 3 concepts"""
+    results = collect_concepts(matcher, term, doc)
+    
+    # Keep the 3 most similar concepts without sorting the whole list
+    return heapq.nlargest(3, results, key=lambda x: x['similarity'])
+
+def _cache_identity():
+    """Describe the index and matcher settings that cached results depend on"""
+    try:
+        quickumls_version = importlib.metadata.version('quickumls')
+    except importlib.metadata.PackageNotFoundError:
+        quickumls_version = 'unknown'
+    try:
+        # A rebuilt index (e.g. a new UMLS release) gets a new modification time
+        index_mtime = os.stat(index_path).st_mtime
+    except OSError:
+        index_mtime = 'missing'
+    return f"{index_mtime}|{quickumls_version}|{match_threshold}|{match_window}"
+
+def _get_cache_db():
+    """Open the query cache database once per process"""
+    global _cache_db, _cache_pid
+    if not use_query_cache:
+        return False
+    if _cache_pid != os.getpid():
+        # Connections must not be shared with forked worker processes
+        _cache_pid = os.getpid()
+        try:
+            _cache_db = sqlite3.connect(query_cache_path, check_same_thread=False)
+            _cache_db.execute("PRAGMA journal_mode=WAL")
+            _cache_db.execute("PRAGMA synchronous=NORMAL")
+            _cache_db.execute(
+                "CREATE TABLE IF NOT EXISTS cache (term TEXT PRIMARY KEY, payload BLOB)")
+            _cache_db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            
+            # Drop results computed against a different index or matcher settings
+            identity = _cache_identity()
+            row = _cache_db.execute("SELECT value FROM meta WHERE key = 'identity'").fetchone()
+            if row is None or row[0] != identity:
+                _cache_db.execute("DELETE FROM cache")
+                _cache_db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('identity', ?)",
+                                  (identity,))
+            _cache_db.commit()
+        except sqlite3.Error:
+            # Caching is an optimization; run without it if the file is unusable
+            _cache_db = False
+    return _cache_db
+
+def cache_lookup(term):
+    """Return cached results for a term, or None on a miss"""
+    db = _get_cache_db()
+    if not db:
+        return None
+    try:
+        with _cache_lock:
+            row = db.execute("SELECT payload FROM cache WHERE term = ?",
+                             (term,)).fetchone()
+    except sqlite3.Error:
+        return None
+    return json.loads(row[0]) if row else None
+
+def cache_store_many(entries):
+    """Persist (term, results) pairs in the query cache with a single commit"""
+    db = _get_cache_db()
+    if not db or not entries:
+        return
+    try:
+        with _cache_lock:
+            db.executemany("INSERT OR REPLACE INTO cache (term, payload) VALUES (?, ?)",
+                           [(term, dumps(results)) for term, results in entries])
+            db.commit()
+    except sqlite3.Error:
+        pass
+
+def memory_lookup(term):
+    """Return results for a term from the in-memory LRU, or None on a miss"""
+    with _memory_lock:
+        results = _memory_cache.get(term)
+        if results is not None:
+            _memory_cache.move_to_end(term)
+        return results
+
+def memory_store(term, results):
+    """Add results for a term to the in-memory LRU, evicting the oldest entry"""
+    with _memory_lock:
+        _memory_cache[term] = results
+        _memory_cache.move_to_end(term)
+        if len(_memory_cache) > _memory_cache_size:
+            _memory_cache.popitem(last=False)
+
+def cached_results(term):
+    """Return results for a term from memory, then disk, or None on a miss"""
+    results = memory_lookup(term)
+    if results is None:
+        results = cache_lookup(term)
+        if results is not None:
+            memory_store(term, results)
+    return results
+
+def warm_query_cache(limit):
+    """Load the most recently stored cache rows into the in-memory cache"""
+    # Check the limit first so a process that will fork never opens the database
+    if limit <= 0:
+        return
+    db = _get_cache_db()
+    if not db:
+        return
+    try:
+        with _cache_lock:
+            rows = db.execute("SELECT term, payload FROM cache ORDER BY rowid DESC LIMIT ?",
+                              (limit,)).fetchall()
+    except sqlite3.Error:
+        return
+    # Insert oldest first so the most recent rows end up least likely to be evicted
+    for term, payload in reversed(rows):
+        memory_store(term, json.loads(payload))
+
+def _match_term(matcher, docs, term):
+    """Match one normalized term, returning (results, succeeded)"""
+    try:
+        return match_concepts(matcher, term, docs.get(term)), True
+    except Exception as e:
+        return [{"error": f"QuickUMLS query failed: {str(e)}"}], False
+
+def query_terms(matcher, terms, executor=None):
+    """Query normalized terms, using the caches for the shared matcher"""
+    use_cache = matcher is _matcher
+    
+    results = {}
+    misses = []
+    for term in terms:
+        cached = cached_results(term) if use_cache else None
+        if cached is None:
+            misses.append(term)
+        else:
+            results[term] = cached
+    
+    # Tokenize only the terms the caches could not answer, in one spaCy pass
+    docs = parse_terms(matcher, misses) if len(misses) > 1 else {}
+    
+    match = functools.partial(_match_term, matcher, docs)
+    matched = executor.map(match, misses) if executor else map(match, misses)
+    
+    new_entries = []
+    for term, (term_results, succeeded) in zip(misses, matched):
+        results[term] = term_results
+        # Errors are returned but never cached
+        if succeeded:
+            new_entries.append((term, term_results))
+    
+    if use_cache:
+        for term, term_results in new_entries:
+            memory_store(term, term_results)
+        # One transaction per batch instead of one commit per term
+        cache_store_many(new_entries)
+    return results
+
+def normalize_term(matcher, term):
+    """Normalize a term for matching, or return None if it is not worth querying"""
+    term = term.strip()
+    
+    # Fold case only when the index was built lowercased; otherwise case matters
+    # (e.g. "HIV", "Parkinson") and must reach the matcher and cache key intact
+    if getattr(matcher, 'to_lowercase_flag', False):
+        term = term.lower()
+    
+    # Skip junk tokens (too short, bare numbers) without calling the matcher
+    if len(term) < min_token_len or term.isdigit():
+        return None
+    return term
+
 def query_quickumls(matcher, term):
     """Query QuickUMLS for CUI mappings"""
     try:
-        matches = matcher.match(term, best_match=True, ignore_syntax=False)
+        term = normalize_term(matcher, term)
+        if term is None:
+            return []
         
-        results = []
-        for match in matches:
-            for concept in match:
-                cui = concept.get('cui', '')
-                # Handle preferred name (could be string or index)
-                preferred = concept.get('preferred', '')
-                if isinstance(preferred, (int, float)):
-                    # If it's an index, get the term from the match
-                    preferred_name = concept.get('term', str(preferred))
-                else:
-                    preferred_name = str(preferred)
-                
-                similarity = concept.get('similarity', 0.0)
-                semtypes = list(concept.get('semtypes', []))
-                
-                results.append({
-                    "cui": cui,
-                    "preferred_name": preferred_name,
-                    "similarity": similarity,
-                    "semtypes": semtypes,
-                    "method": "quickumls"
-                })
-        
-        # Sort by similarity and return top 3
-        results.sort(key=lambda x: x['similarity'], reverse=True)
-        return results[:3]
+        return query_terms(matcher, [term])[term]
         
     except Exception as e:
         return [{"error": f"QuickUMLS query failed: {str(e)}"}]
 
-def batch_query_quickumls(matcher, terms):
+def _query_worker(terms):
+    """Query normalized terms in a worker process using that process's own matcher"""
+    return query_terms(_matcher, terms)
+
+def _initialize_worker(token_len, disk_cache, warm_limit):
+    """Build a fresh matcher in a worker process instead of the forked copy"""
+    global _matcher, min_token_len, use_query_cache
+    # Settings from main() are not inherited under the spawn/forkserver start methods
+    min_token_len = token_len
+    use_query_cache = disk_cache
+    _matcher = None
+    initialize_quickumls()
+    
+    # Lookups run in the workers, so each warms its own in-memory cache
+    warm_query_cache(warm_limit)
+
+def default_workers():
+    """Number of CPUs this process may run on"""
+    # On shared cluster nodes cpu_count() is the whole node, not the job's allocation
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def create_executor(workers=None, use_processes=False, warm_limit=0):
+    """Create the pool used to query batch terms concurrently"""
+    if workers is None:
+        workers = default_workers()
+    if use_processes:
+        # Each worker process loads its own matcher once at startup
+        return ProcessPoolExecutor(max_workers=workers, initializer=_initialize_worker,
+                                   initargs=(min_token_len, use_query_cache, warm_limit))
+    return ThreadPoolExecutor(max_workers=workers)
+
+def batch_query_quickumls(matcher, terms, executor=None):
     """Query QuickUMLS for multiple terms efficiently"""
     try:
-        batch_results = {}
+        # Query each distinct term once, keeping first-seen order
+        unique_terms = list(dict.fromkeys(terms))
+        
+        if executor is None:
+            with create_executor() as pool:
+                return batch_query_quickumls(matcher, unique_terms, pool)
+        
+        normalized = {term: normalize_term(matcher, term) for term in unique_terms}
+        query_list = list(dict.fromkeys(filter(None, normalized.values())))
+        
+        if isinstance(executor, ProcessPoolExecutor):
+            # Send chunks so each worker makes one cache commit per chunk
+            chunks = [query_list[i:i + worker_chunk_size]
+                      for i in range(0, len(query_list), worker_chunk_size)]
+            results = {}
+            for chunk_results in executor.map(_query_worker, chunks):
+                results.update(chunk_results)
+        else:
+            # Matching mostly runs in C extensions, so threads overlap well
+            results = query_terms(matcher, query_list, executor)
+        
+        batch_results = {term: results[key] if key is not None else []
+                         for term, key in normalized.items()}
+        return batch_results
+        
+    except Exception as e:
+        return {"error": f"Batch QuickUMLS query failed: {str(e)}"}
+
+def batch_query_quickumls_topk(matcher, terms, k=3, global_topk=False):
+    """Rank concepts for a batch of terms in one pass over all matches"""
+    try:
+        unique_terms = list(dict.fromkeys(terms))
+        normalized = {term: normalize_term(matcher, term) for term in unique_terms}
         
-        for term in terms:
-            results = query_quickumls(matcher, term)
-            batch_results[term] = results
+        # Match each normalized term once, so case variants do not repeat concepts
+        query_list = list(dict.fromkeys(filter(None, normalized.values())))
+        docs = parse_terms(matcher, query_list)
+        
+        # One (term, concept) list for the whole batch, grouped by term
+        items = []
+        errors = {}
+        for term in query_list:
+            try:
+                concepts = collect_concepts(matcher, term, docs.get(term))
+            except Exception as e:
+                errors[term] = {"error": f"QuickUMLS query failed: {str(e)}"}
+                continue
+            items.extend((term, concept) for concept in concepts)
+        
+        if global_topk:
+            # Tag results with the caller's term (or terms, when several fold to one key)
+            original_terms = collections.defaultdict(list)
+            for term, key in normalized.items():
+                if key is not None:
+                    original_terms[key].append(term)
+            tags = {key: terms[0] if len(terms) == 1 else terms
+                    for key, terms in original_terms.items()}
             
+            # Most similar concepts across the batch; terms that failed are reported after them
+            top_items = heapq.nlargest(k, items, key=lambda x: x[1]['similarity'])
+            return ([{"term": tags[key], **concept} for key, concept in top_items]
+                    + [{"term": tags[key], **error} for key, error in errors.items()])
+        
+        top_concepts = {term: [error] for term, error in errors.items()}
+        for term, group in itertools.groupby(items, key=lambda x: x[0]):
+            top_items = heapq.nlargest(k, group, key=lambda x: x[1]['similarity'])
+            top_concepts[term] = [concept for _, concept in top_items]
+        
+        batch_results = {term: top_concepts.get(key, []) if key is not None else []
+                         for term, key in normalized.items()}
         return batch_results
         
     except Exception as e:
         return {"error": f"Batch QuickUMLS query failed: {str(e)}"}
 
+def stream_batch_file(matcher, batch_file, chunk_size=1024, executor=None):
+    """Query terms from a file chunk by chunk, writing one JSON line per input line"""
+    with open(batch_file, 'r') as f:
+        chunk = []
+        for line in f:
+            term = line.strip()
+            if term:
+                chunk.append(term)
+            if len(chunk) >= chunk_size:
+                _write_batch_lines(chunk, batch_query_quickumls(matcher, chunk, executor))
+                chunk = []
+        if chunk:
+            _write_batch_lines(chunk, batch_query_quickumls(matcher, chunk, executor))
+
+def _write_batch_lines(terms, batch_results):
+    """Write results for each term, in input order, as newline-delimited JSON and flush"""
+    # A failed batch returns a single error; report it against every term
+    batch_error = batch_results.get("error")
+    for term in terms:
+        if isinstance(batch_error, str):
+            results = [{"error": batch_error}]
+        else:
+            results = batch_results[term]
+        sys.stdout.write(dumps({term: results}) + "\n")
+    sys.stdout.flush()
+
+def serve_quickumls(matcher, executor=None):
+    """Answer newline-delimited JSON requests on stdin until EOF"""
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('request must be a JSON object')
+            terms = request.get('terms', [])
+            if not isinstance(terms, list) or not all(isinstance(term, str) for term in terms):
+                raise ValueError('"terms" must be a list of strings')
+            response = batch_query_quickumls(matcher, terms, executor)
+        except Exception as e:
+            response = {"error": f"Invalid request: {str(e)}"}
+        
+        sys.stdout.write(dumps(response) + "\n")
+        sys.stdout.flush()
+
+def positive_int(value):
+    """argparse type for options that must be at least 1"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
 def main():
+    global min_token_len, use_query_cache
     parser = argparse.ArgumentParser(description='QuickUMLS Wrapper for CUI mapping')
     parser.add_argument('--term', help='Single medical term to map to CUI')
-    parser.add_argument('--batch-file', help='File containing terms (one per line)')
+    parser.add_argument('--batch-file',
+                       help='File containing terms (one per line); results are written as '
+                            'one JSON line per non-empty input line, in input order')
     parser.add_argument('--batch-terms', nargs='+', help='Multiple terms as arguments')
     parser.add_argument('--output', default='json', choices=['json', 'simple'], 
                        help='Output format')
+    parser.add_argument('--global-topk', type=positive_int, metavar='K',
+                       help='With --batch-terms, return the K most similar concepts '
+                            'across all terms')
+    parser.add_argument('--serve', action='store_true',
+                       help='Keep the matcher loaded and answer JSON requests '
+                            '({"terms": [...]}, one per line) on stdin')
+    parser.add_argument('--warm-cache', type=int, default=0, metavar='N',
+                       help='With --serve, preload the N most recent cached terms '
+                            '(into each worker with --processes)')
+    parser.add_argument('--workers', type=positive_int, default=None,
+                       help='Number of concurrent batch workers (default: CPUs available '
+                            'to this process)')
+    parser.add_argument('--processes', action='store_true',
+                       help='Use worker processes instead of threads for batches')
+    parser.add_argument('--min-token-len', type=int, default=min_token_len,
+                       help='Skip terms shorter than this without querying')
+    parser.add_argument('--no-cache', action='store_true',
+                       help='Do not read or write the persistent query cache')
+    parser.add_argument('--chunk-size', type=positive_int, default=1024,
+                       help='Terms read from --batch-file per batch')
     
     args = parser.parse_args()
     
-    # Initialize QuickUMLS
+    min_token_len = args.min_token_len
+    use_query_cache = not args.no_cache
+    
+    if not (args.serve or args.batch_file or args.batch_terms or args.term):
+        print("Error: Must provide either --term, --batch-file, --batch-terms, or --serve")
+        sys.exit(1)
+    
+    if args.global_topk is not None and (args.serve or args.batch_file or not args.batch_terms):
+        print("Error: --global-topk can only be used with --batch-terms")
+        sys.exit(1)
+    
+    # Initialize QuickUMLS only once there is work to do
     matcher = initialize_quickumls()
     
     # Determine input mode
-    if args.batch_file:
-        # Read terms from file
-        with open(args.batch_file, 'r') as f:
-            terms = [line.strip() for line in f if line.strip()]
-        batch_results = batch_query_quickumls(matcher, terms)
-        print(json.dumps(batch_results, indent=2))
+    if args.serve:
+        # Persistent mode: one interpreter start and index load for many queries
+        if not args.processes:
+            warm_query_cache(args.warm_cache)
+        with create_executor(args.workers, args.processes, args.warm_cache) as executor:
+            serve_quickumls(matcher, executor)
+        
+    elif args.batch_file:
+        # Stream terms from file, emitting one JSON object per line
+        with create_executor(args.workers, args.processes) as executor:
+            stream_batch_file(matcher, args.batch_file, args.chunk_size, executor)
         
     elif args.batch_terms:
         # Process multiple terms from command line
-        batch_results = batch_query_quickumls(matcher, args.batch_terms)
-        print(json.dumps(batch_results, indent=2))
+        if args.global_topk is not None:
+            batch_results = batch_query_quickumls_topk(matcher, args.batch_terms,
+                                                       args.global_topk, global_topk=True)
+        else:
+            with create_executor(args.workers, args.processes) as executor:
+                batch_results = batch_query_quickumls(matcher, args.batch_terms, executor)
+        print(dumps(batch_results, indent=True))
         
-    elif args.term:
+    else:
         # Single term mode (backward compatibility)
         results = query_quickumls(matcher, args.term)
         
         if args.output == 'json':
-            print(json.dumps(results, indent=2))
+            print(dumps(results, indent=True))
         else:
             for result in results:
                 if "error" not in result:
@@ -125,9 +571,6 @@ def main():
                     print(f"Preferred: {result['preferred_name']}")
                     print(f"Similarity: {result['similarity']:.3f}")
                     print("---")
-    else:
-        print("Error: Must provide either --term, --batch-file, or --batch-terms")
-        sys.exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file